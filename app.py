@@ -1,10 +1,18 @@
 import os
 import re
 import logging
+import threading
+from typing import Optional
 from dotenv import load_dotenv
-from slack_bolt import App
+from slack_bolt import App, BoltResponse
 from slack_bolt.adapter.socket_mode import SocketModeHandler
-from dify_client import DifyClient
+from slack_bolt.oauth.oauth_settings import OAuthSettings
+from slack_sdk.oauth.installation_store.sqlite3 import SQLite3InstallationStore
+from slack_sdk.oauth.state_store.sqlite3 import SQLite3OAuthStateStore
+from dify_client import CancelToken, DifyCancelledError
+from prompts import EMOJI_ACTIONS
+from reaper import ConversationReaper
+from workspaces import CachedInstallationStoreAuthorize, OAuthInstallHandler, WorkspaceRegistry, serve_oauth
 
 # 設定 logging
 logging.basicConfig(
@@ -17,69 +25,111 @@ logger = logging.getLogger(__name__)
 # 載入 .env 環境變數
 load_dotenv()
 
-# 初始化 Slack App
-app = App(token=os.environ["SLACK_BOT_TOKEN"])
+# Bot 需要的 scopes（OAuth 安裝時使用）
+BOT_SCOPES = [
+    "chat:write",
+    "commands",
+    "app_mentions:read",
+    "channels:history",
+    "groups:history",
+    "im:history",
+    "im:write",
+    "reactions:read",
+]
 
-# 初始化 Dify Client
-dify = DifyClient()
+# 初始化 Slack App
+# 有設定 SLACK_CLIENT_ID 時啟用 OAuth 多 workspace 安裝，否則使用單一 Bot Token
+MULTI_WORKSPACE = bool(os.environ.get("SLACK_CLIENT_ID"))
+
+if MULTI_WORKSPACE:
+    oauth_db = os.environ.get("SLACK_OAUTH_DB", "./data/slack_oauth.db")
+    os.makedirs(os.path.dirname(oauth_db) or ".", exist_ok=True)
+
+    class InstallationStore(SQLite3InstallationStore):
+        """重新安裝時清除授權快取"""
+
+        def save(self, installation):
+            super().save(installation)
+            authorize.clear(installation.enterprise_id, installation.team_id)
+
+    installation_store = InstallationStore(
+        database=oauth_db,
+        client_id=os.environ["SLACK_CLIENT_ID"],
+    )
+
+    # 快取各 team 的授權結果，避免每個事件都查 SQLite 並呼叫 auth.test
+    authorize = CachedInstallationStoreAuthorize(
+        logger=logger,
+        installation_store=installation_store,
+        client_id=os.environ["SLACK_CLIENT_ID"],
+        client_secret=os.environ["SLACK_CLIENT_SECRET"],
+        bot_only=True,
+    )
+
+    app = App(
+        signing_secret=os.environ.get("SLACK_SIGNING_SECRET"),
+        authorize=authorize,
+        oauth_settings=OAuthSettings(
+            client_id=os.environ["SLACK_CLIENT_ID"],
+            client_secret=os.environ["SLACK_CLIENT_SECRET"],
+            scopes=BOT_SCOPES,
+            installation_store=installation_store,
+            state_store=SQLite3OAuthStateStore(
+                database=oauth_db,
+                expiration_seconds=600,
+            ),
+        ),
+    )
+
+    # OAuth 安裝頁面的 WSGI app，也可用 gunicorn app:oauth_app 另外部署
+    oauth_app = OAuthInstallHandler(app)
+else:
+    app = App(token=os.environ["SLACK_BOT_TOKEN"])
+
+# 各 workspace 的 Dify client 與 rate limit
+# rate limit 預設只在多 workspace 模式啟用
+workspaces = WorkspaceRegistry(
+    rate_per_minute=float(os.environ.get("TEAM_RATE_LIMIT_PER_MINUTE", "60" if MULTI_WORKSPACE else "0")),
+)
 
 # 儲存對話 ID 的對應
-# Key: "dm:{user_id}" 或 "thread:{channel}:{thread_ts}"
+# Key: "{team_id}:dm:{user_id}"、"{team_id}:thread:{channel}:{thread_ts}"
+#      或 "{team_id}:assistant:{channel}:{thread_ts}"
 # Value: Dify conversation_id
 # 正式環境建議用 Redis 或資料庫
 conversations: dict[str, str] = {}
 
-# Emoji 對應的動作
-# 注意：Slack emoji 名稱可能因 workspace 而異
-EMOJI_ACTIONS = {
-    # 📝 摘要
-    "memo": {
-        "action": "summarize",
-        "prompt": "請摘要以下內容，用繁體中文回覆：\n\n{text}",
-    },
-    # 🇺🇸 翻英文（多種可能的名稱）
-    "flag-us": {
-        "action": "translate",
-        "prompt": "請將以下內容翻譯成英文：\n\n{text}",
-    },
-    "us": {
-        "action": "translate",
-        "prompt": "請將以下內容翻譯成英文：\n\n{text}",
-    },
-    # 🇯🇵 翻日文
-    "flag-jp": {
-        "action": "translate",
-        "prompt": "請將以下內容翻譯成日文：\n\n{text}",
-    },
-    "jp": {
-        "action": "translate",
-        "prompt": "請將以下內容翻譯成日文：\n\n{text}",
-    },
-    # 🇹🇼 翻繁中
-    "flag-tw": {
-        "action": "translate",
-        "prompt": "請將以下內容翻譯成繁體中文：\n\n{text}",
-    },
-    "tw": {
-        "action": "translate",
-        "prompt": "請將以下內容翻譯成繁體中文：\n\n{text}",
-    },
-    # ❓ 解釋
-    "question": {
-        "action": "explain",
-        "prompt": "請解釋以下內容，用繁體中文回覆：\n\n{text}",
-    },
-}
-
-
-def get_dm_key(user_id: str) -> str:
+# 背景刪除閒置過久的 Dify 對話
+reaper = ConversationReaper(
+    conversations,
+    client_for=workspaces.dify,
+    is_busy=lambda key: key in in_flight_by_conversation,
+)
+
+# 進行中的 Dify 請求，用來取消被取代或放棄的回覆
+# in_flight_by_conversation Key: 對話 key（同一對話有新訊息時取消舊的）
+# in_flight_by_message Key: "{team_id}:{channel}:{ts}"（觸發訊息被刪除或編輯時取消）
+#     同一則訊息可能同時有多個請求（例如 🇺🇸 與 🇯🇵 兩個 reaction）
+in_flight_by_conversation: dict[str, CancelToken] = {}
+in_flight_by_message: dict[str, set[CancelToken]] = {}
+_in_flight_lock = threading.Lock()
+
+CANCELLED_TEXT = "_🚫 已取消回覆_"
+
+
+def get_dm_key(team_id: str, user_id: str) -> str:
     """產生 DM 對話的 key"""
-    return f"dm:{user_id}"
+    return f"{team_id}:dm:{user_id}"
 
 
-def get_thread_key(channel: str, thread_ts: str) -> str:
+def get_thread_key(team_id: str, channel: str, thread_ts: str) -> str:
     """產生 thread 對話的 key"""
-    return f"thread:{channel}:{thread_ts}"
+    return f"{team_id}:thread:{channel}:{thread_ts}"
+
+
+def get_assistant_key(team_id: str, channel: str, thread_ts: str) -> str:
+    """產生 Assistant thread 對話的 key"""
+    return f"{team_id}:assistant:{channel}:{thread_ts}"
 
 
 def clean_mention(text: str, bot_user_id: str) -> str:
@@ -94,6 +144,190 @@ def get_bot_user_id(client) -> str:
     return auth_response["user_id"]
 
 
+def get_conversation(key: str, user_id: str, team_id: str) -> Optional[str]:
+    """取得對話 ID 並更新最後使用時間，已被回收的對話回傳 None"""
+    conversation_id = conversations.get(key)
+    if conversation_id and not reaper.touch(key, conversation_id, user_id, team_id):
+        return None
+    return conversation_id
+
+
+def remember_conversation(key: str, conversation_id: str, user_id: str, team_id: str) -> None:
+    """儲存對話 ID 並更新最後使用時間，已排入刪除的對話不寫回"""
+    if reaper.touch(key, conversation_id, user_id, team_id):
+        conversations[key] = conversation_id
+
+
+def discard_abandoned_conversation(key: str, error: Exception, user_id: str, team_id: str) -> None:
+    """請求取消或中途失敗時，刪除已在 Dify 建立但沒有保存的新對話"""
+    conversation_id = getattr(error, "conversation_id", "")
+    if conversation_id and conversations.get(key) != conversation_id:
+        reaper.discard(key, conversation_id, user_id, team_id)
+
+
+def get_message_key(team_id: str, channel: str, ts: str) -> str:
+    """產生觸發訊息的 key"""
+    return f"{team_id}:{channel}:{ts}"
+
+
+# ============================================
+# 取消進行中的請求
+# ============================================
+def start_request(team_id: str, conv_key: str = None, message_key: str = None) -> Optional[CancelToken]:
+    """
+    扣除 team 額度並登記新的請求，同一對話中尚未完成的舊請求會被取消
+    同一則訊息已在處理中（app_mention 與 message 重複事件）時回傳 None
+    額度不足時拋出 RateLimitError，舊的請求不受影響
+    """
+    token = CancelToken()
+
+    with _in_flight_lock:
+        running = in_flight_by_message.get(message_key, set()) if message_key else set()
+        if conv_key and in_flight_by_conversation.get(conv_key) in running:
+            return None
+
+        # 不會等待，在鎖內檢查可避免重複事件同時通過
+        workspaces.acquire(team_id)
+
+        superseded = in_flight_by_conversation.get(conv_key) if conv_key else None
+        if conv_key:
+            in_flight_by_conversation[conv_key] = token
+        if message_key:
+            in_flight_by_message.setdefault(message_key, set()).add(token)
+
+    if superseded:
+        logger.info(f"Cancelling superseded request: {conv_key}")
+        superseded.cancel()
+
+    return token
+
+
+def finish_request(token: CancelToken, conv_key: str = None, message_key: str = None) -> None:
+    """請求結束後移除登記"""
+    with _in_flight_lock:
+        if conv_key and in_flight_by_conversation.get(conv_key) is token:
+            del in_flight_by_conversation[conv_key]
+        tokens = in_flight_by_message.get(message_key) if message_key else None
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del in_flight_by_message[message_key]
+
+
+def cancel_conversation_requests(key: str, prefix: bool = False) -> int:
+    """取消對話的請求（prefix=True 時取消所有以 key 開頭的對話），回傳取消數量"""
+    with _in_flight_lock:
+        tokens = [
+            t for k, t in in_flight_by_conversation.items()
+            if k == key or (prefix and k.startswith(key))
+        ]
+
+    for token in tokens:
+        token.cancel()
+    return len(tokens)
+
+
+def cancel_message_request(message_key: str) -> bool:
+    """取消由指定訊息觸發的所有請求"""
+    with _in_flight_lock:
+        tokens = list(in_flight_by_message.get(message_key, ()))
+
+    for token in tokens:
+        token.cancel()
+    return bool(tokens)
+
+
+def get_edited_message_ts(event: dict) -> str:
+    """取得被刪除或內容被編輯的訊息 ts，其他事件回傳空字串"""
+    subtype = event.get("subtype")
+    if subtype == "message_deleted":
+        return event.get("deleted_ts", "")
+
+    if subtype == "message_changed":
+        message = event.get("message") or {}
+        previous = event.get("previous_message") or {}
+        # unfurl、回覆數更新等也會觸發 message_changed，只處理文字真的有變的情況
+        if message.get("text") != previous.get("text"):
+            return message.get("ts", "")
+
+    return ""
+
+
+# ============================================
+# Global Middleware: 預先過濾無關的頻道訊息
+# ============================================
+# 大型 workspace 中每則頻道訊息都會送進來，
+# 在交給 listener thread 之前先丟掉一定不會回覆的訊息
+dropped_events = 0
+_dropped_lock = threading.Lock()
+
+
+def is_relevant_message(team_id: str, event: dict) -> bool:
+    """判斷 message 事件是否可能需要 Bot 回覆"""
+    # DM（含 Assistant thread）一律交給 handle_message
+    if event.get("channel_type") == "im":
+        return True
+
+    # 關鍵字 ping（與 @app.message("ping") 相同條件，但不跑 regex）
+    if "ping" in event.get("text", ""):
+        return True
+
+    # 觸發中回覆的訊息被刪除或編輯
+    edited_ts = get_edited_message_ts(event)
+    if edited_ts and get_message_key(team_id, event.get("channel", ""), edited_ts) in in_flight_by_message:
+        return True
+
+    # 只有已經有對話的 thread 才需要延續
+    thread_ts = event.get("thread_ts")
+    if thread_ts and get_thread_key(team_id, event.get("channel", ""), thread_ts) in conversations:
+        return True
+
+    return False
+
+
+@app.middleware
+def filter_irrelevant_messages(body, context, next):
+    """丟棄不會回覆的頻道訊息，不呼叫 next() 即不會派發給 listener"""
+    global dropped_events
+
+    event = body.get("event") or {}
+    if event.get("type") != "message" or is_relevant_message(context.team_id, event):
+        return next()
+
+    with _dropped_lock:
+        dropped_events += 1
+        count = dropped_events
+    if count % 1000 == 0:
+        logger.info(f"Filtered {count} irrelevant message events")
+    return BoltResponse(status=200, body="")
+
+
+if MULTI_WORKSPACE:
+    @app.event("tokens_revoked")
+    def handle_tokens_revoked(event, context):
+        """Bot token 被撤銷：刪除安裝資料並清除授權快取"""
+        if event.get("tokens", {}).get("bot"):
+            installation_store.delete_bot(enterprise_id=context.enterprise_id, team_id=context.team_id)
+        authorize.clear(context.enterprise_id, context.team_id)
+
+    @app.event("app_uninstalled")
+    def handle_app_uninstalled(context):
+        """App 被移除：刪除所有安裝資料並清除授權快取"""
+        installation_store.delete_all(enterprise_id=context.enterprise_id, team_id=context.team_id)
+        authorize.clear(context.enterprise_id, context.team_id)
+
+
+def get_team_dify(team_id: str, oneshot: bool = False):
+    """
+    扣除 team 額度並取得對應的 Dify client
+    oneshot=True 時取得一次性問答用的 client（completion / workflow App）
+    """
+    workspaces.acquire(team_id)
+    if oneshot:
+        return workspaces.oneshot(team_id)
+    return workspaces.dify(team_id)
+
+
 # ============================================
 # Slash Command: /help
 # ============================================
@@ -135,7 +369,7 @@ def handle_help_command(ack, respond):
 # Slash Command: /ask（公開）
 # ============================================
 @app.command("/ask")
-def handle_ask_command(ack, command, client, respond):
+def handle_ask_command(ack, command, client, respond, context):
     """
     公開問 AI - 問題和回答都會顯示在頻道中
     在 DM 中使用時改用 respond
@@ -151,6 +385,8 @@ def handle_ask_command(ack, command, client, respond):
         return
 
     try:
+        dify = get_team_dify(context.team_id, oneshot=True)
+
         # 嘗試發送到頻道（公開）
         try:
             question_msg = client.chat_postMessage(
@@ -163,7 +399,7 @@ def handle_ask_command(ack, command, client, respond):
                 text="_responding..._",
             )
 
-            answer, _ = dify.chat_complete(
+            answer = dify.complete(
                 query=query,
                 user=user_id,
                 stream=True,
@@ -178,7 +414,7 @@ def handle_ask_command(ack, command, client, respond):
         except Exception as channel_error:
             # 如果頻道發送失敗（例如在 DM 中），改用 respond
             if "channel_not_found" in str(channel_error):
-                answer, _ = dify.chat_complete(
+                answer = dify.complete(
                     query=query,
                     user=user_id,
                     stream=True,
@@ -195,7 +431,7 @@ def handle_ask_command(ack, command, client, respond):
 # Slash Command: /ask-private（私密）
 # ============================================
 @app.command("/ask-private")
-def handle_ask_private_command(ack, command, respond):
+def handle_ask_private_command(ack, command, respond, context):
     """
     私密問 AI - 只有自己看得到
     """
@@ -209,7 +445,8 @@ def handle_ask_private_command(ack, command, respond):
         return
 
     try:
-        answer, _ = dify.chat_complete(
+        dify = get_team_dify(context.team_id, oneshot=True)
+        answer = dify.complete(
             query=query,
             user=user_id,
             stream=True,
@@ -225,25 +462,33 @@ def handle_ask_private_command(ack, command, respond):
 # Slash Command: /reset
 # ============================================
 @app.command("/reset")
-def handle_reset_command(ack, command, respond):
+def handle_reset_command(ack, command, respond, context):
     """清除 DM 對話歷史"""
     ack()
 
     user_id = command["user_id"]
     channel_id = command["channel_id"]
-    dm_key = get_dm_key(user_id)
+    dm_key = get_dm_key(context.team_id, user_id)
+    assistant_prefix = get_assistant_key(context.team_id, channel_id, "")
+
+    # 取消進行中的回覆
+    cancel_conversation_requests(dm_key)
+    cancel_conversation_requests(assistant_prefix, prefix=True)
 
     # 清除一般 DM 對話
     cleared_count = 0
-    if dm_key in conversations:
-        del conversations[dm_key]
+    conversation_id = conversations.pop(dm_key, None)
+    if conversation_id:
+        reaper.discard(dm_key, conversation_id, user_id, context.team_id)
         cleared_count += 1
 
     # 清除該 channel 下所有 assistant thread 的對話
-    assistant_keys = [k for k in conversations.keys() if k.startswith(f"assistant:{channel_id}:")]
+    assistant_keys = [k for k in list(conversations) if k.startswith(assistant_prefix)]
     for key in assistant_keys:
-        del conversations[key]
-        cleared_count += 1
+        conversation_id = conversations.pop(key, None)
+        if conversation_id:
+            reaper.discard(key, conversation_id, user_id, context.team_id)
+            cleared_count += 1
 
     if cleared_count > 0:
         respond(f"✅ 已清除 {cleared_count} 個對話歷史！\n💡 提示：在 Slack Assistant 模式下，開新 thread 即可開始全新對話。")
@@ -272,7 +517,7 @@ def handle_hello_command(ack, command, respond):
 # 監聽 @mention - 公開問答
 # ============================================
 @app.event("app_mention")
-def handle_mention(event, say, client):
+def handle_mention(event, say, client, context):
     """
     當有人 @bot 時，公開回覆（類似 /ask）
     在 thread 中會保持上下文
@@ -294,10 +539,19 @@ def handle_mention(event, say, client):
         return
 
     # 查找 thread 對話
-    thread_key = get_thread_key(channel, thread_ts)
-    conversation_id = conversations.get(thread_key)
+    thread_key = get_thread_key(context.team_id, channel, thread_ts)
+    conversation_id = get_conversation(thread_key, user_id, context.team_id)
+
+    message_key = get_message_key(context.team_id, channel, message_ts)
+    cancel_token = None
 
     try:
+        cancel_token = start_request(context.team_id, thread_key, message_key)
+        if cancel_token is None:
+            # 重複事件，已由另一個 handler 處理
+            return
+        dify = workspaces.dify(context.team_id)
+
         # 顯示 responding 狀態
         responding_msg = client.chat_postMessage(
             channel=channel,
@@ -310,10 +564,11 @@ def handle_mention(event, say, client):
             user=user_id,
             conversation_id=conversation_id,
             stream=True,
+            cancel_token=cancel_token,
         )
 
         if new_conversation_id:
-            conversations[thread_key] = new_conversation_id
+            remember_conversation(thread_key, new_conversation_id, user_id, context.team_id)
 
         # 更新回答
         client.chat_update(
@@ -322,15 +577,24 @@ def handle_mention(event, say, client):
             text=answer,
         )
 
+    except DifyCancelledError as e:
+        discard_abandoned_conversation(thread_key, e, user_id, context.team_id)
+        client.chat_update(channel=channel, ts=responding_msg["ts"], text=CANCELLED_TEXT)
+
     except Exception as e:
+        discard_abandoned_conversation(thread_key, e, user_id, context.team_id)
         say(text=f"❌ 抱歉，發生錯誤：{str(e)}", thread_ts=thread_ts)
 
+    finally:
+        if cancel_token:
+            finish_request(cancel_token, thread_key, message_key)
+
 
 # ============================================
 # DM 多輪對話
 # ============================================
 @app.event("message")
-def handle_message(event, say, client, logger):
+def handle_message(event, say, client, logger, context):
     """
     處理訊息事件：
     1. DM 直接對話（多輪）
@@ -339,6 +603,13 @@ def handle_message(event, say, client, logger):
     # Debug: 印出收到的事件
     print(f"\n📨 Message event: channel_type={event.get('channel_type')}, subtype={event.get('subtype')}, bot_id={event.get('bot_id')}")
 
+    # 觸發訊息被刪除或編輯：取消進行中的回覆
+    edited_ts = get_edited_message_ts(event)
+    if edited_ts:
+        if cancel_message_request(get_message_key(context.team_id, event["channel"], edited_ts)):
+            print(f"   🚫 Cancelled reply for edited/deleted message {edited_ts}")
+        return
+
     # 忽略 bot 訊息、子類型訊息
     if event.get("bot_id") or event.get("subtype"):
         return
@@ -359,17 +630,27 @@ def handle_message(event, say, client, logger):
         
         if thread_ts:
             # Assistant thread 模式：用 thread_ts 作為 key
-            conv_key = f"assistant:{channel}:{thread_ts}"
+            conv_key = get_assistant_key(context.team_id, channel, thread_ts)
             print(f"💬 Assistant thread from user {user_id}: {text[:50]}...")
         else:
             # 一般 DM 模式：用 user_id 作為 key
-            conv_key = get_dm_key(user_id)
+            conv_key = get_dm_key(context.team_id, user_id)
             print(f"💬 DM received from user {user_id}: {text[:50]}...")
         
-        conversation_id = conversations.get(conv_key)
+        conversation_id = get_conversation(conv_key, user_id, context.team_id)
         print(f"   Conv key: {conv_key}, existing conversation: {conversation_id}")
 
+        # 同一對話有新訊息時，舊的回覆會被取消
+        message_key = get_message_key(context.team_id, channel, event["ts"])
+        cancel_token = None
+
         try:
+            cancel_token = start_request(context.team_id, conv_key, message_key)
+            if cancel_token is None:
+                # 重複事件，已由另一個 handler 處理
+                return
+            dify = workspaces.dify(context.team_id)
+
             # 顯示 responding 狀態
             # Assistant 模式下要回覆到 thread
             msg_kwargs = {"channel": channel, "text": "_responding..._"}
@@ -383,10 +664,11 @@ def handle_message(event, say, client, logger):
                 user=user_id,
                 conversation_id=conversation_id,
                 stream=True,
+                cancel_token=cancel_token,
             )
 
             if new_conversation_id:
-                conversations[conv_key] = new_conversation_id
+                remember_conversation(conv_key, new_conversation_id, user_id, context.team_id)
                 print(f"   ✅ Updated conversation_id: {new_conversation_id}")
 
             # 更新回答
@@ -396,14 +678,24 @@ def handle_message(event, say, client, logger):
                 text=answer,
             )
 
+        except DifyCancelledError as e:
+            print(f"   🚫 DM reply cancelled: {conv_key}")
+            discard_abandoned_conversation(conv_key, e, user_id, context.team_id)
+            client.chat_update(channel=channel, ts=responding_msg["ts"], text=CANCELLED_TEXT)
+
         except Exception as e:
             print(f"   ❌ DM Dify error: {e}")
+            discard_abandoned_conversation(conv_key, e, user_id, context.team_id)
             logger.error(f"DM Dify error: {e}")
             error_kwargs = {"text": f"❌ 抱歉，發生錯誤：{str(e)}"}
             if thread_ts:
                 error_kwargs["thread_ts"] = thread_ts
             say(**error_kwargs)
 
+        finally:
+            if cancel_token:
+                finish_request(cancel_token, conv_key, message_key)
+
         return
 
     # ---- Thread 延續對話 ----
@@ -411,8 +703,8 @@ def handle_message(event, say, client, logger):
     if not thread_ts:
         return
 
-    thread_key = get_thread_key(channel, thread_ts)
-    conversation_id = conversations.get(thread_key)
+    thread_key = get_thread_key(context.team_id, channel, thread_ts)
+    conversation_id = get_conversation(thread_key, user_id, context.team_id)
 
     if not conversation_id:
         return
@@ -424,7 +716,16 @@ def handle_message(event, say, client, logger):
     if not query:
         return
 
+    message_key = get_message_key(context.team_id, channel, event["ts"])
+    cancel_token = None
+
     try:
+        cancel_token = start_request(context.team_id, thread_key, message_key)
+        if cancel_token is None:
+            # 重複事件，已由另一個 handler 處理
+            return
+        dify = workspaces.dify(context.team_id)
+
         # 顯示 responding 狀態
         responding_msg = client.chat_postMessage(
             channel=channel,
@@ -437,10 +738,11 @@ def handle_message(event, say, client, logger):
             user=user_id,
             conversation_id=conversation_id,
             stream=True,
+            cancel_token=cancel_token,
         )
 
         if new_conversation_id:
-            conversations[thread_key] = new_conversation_id
+            remember_conversation(thread_key, new_conversation_id, user_id, context.team_id)
 
         # 更新回答
         client.chat_update(
@@ -449,17 +751,27 @@ def handle_message(event, say, client, logger):
             text=answer,
         )
 
+    except DifyCancelledError as e:
+        print(f"   🚫 Thread reply cancelled: {thread_key}")
+        discard_abandoned_conversation(thread_key, e, user_id, context.team_id)
+        client.chat_update(channel=channel, ts=responding_msg["ts"], text=CANCELLED_TEXT)
+
     except Exception as e:
         print(f"   ❌ Thread Dify error: {e}")
+        discard_abandoned_conversation(thread_key, e, user_id, context.team_id)
         logger.error(f"Thread Dify error: {e}")
         say(text=f"❌ 抱歉，發生錯誤：{str(e)}", thread_ts=thread_ts)
 
+    finally:
+        if cancel_token:
+            finish_request(cancel_token, thread_key, message_key)
+
 
 # ============================================
 # Emoji Reaction 觸發
 # ============================================
 @app.event("reaction_added")
-def handle_reaction(event, client, logger):
+def handle_reaction(event, client, logger, context):
     """
     處理 Emoji 觸發：
     📝 摘要、🇺🇸 翻英、🇯🇵 翻日、🇹🇼 翻繁中、❓ 解釋
@@ -483,7 +795,13 @@ def handle_reaction(event, client, logger):
     if not channel or not message_ts:
         return
 
+    # 原始訊息被刪除或編輯時取消
+    message_key = get_message_key(context.team_id, channel, message_ts)
+    cancel_token = None
+
     try:
+        cancel_token = start_request(context.team_id, message_key=message_key)
+
         # 取得原始訊息內容
         result = client.conversations_history(
             channel=channel,
@@ -500,6 +818,8 @@ def handle_reaction(event, client, logger):
         if not original_text:
             return
 
+        dify = workspaces.oneshot(context.team_id)
+
         # 組合 prompt
         action_config = EMOJI_ACTIONS[reaction]
         prompt = action_config["prompt"].format(text=original_text)
@@ -512,10 +832,11 @@ def handle_reaction(event, client, logger):
         )
 
         # 發送到 Dify
-        answer, _ = dify.chat_complete(
+        answer = dify.complete(
             query=prompt,
             user=user_id,
             stream=True,
+            cancel_token=cancel_token,
         )
 
         # 更新回答
@@ -525,8 +846,14 @@ def handle_reaction(event, client, logger):
             text=answer,
         )
 
+    except DifyCancelledError as e:
+        print(f"   🚫 Reaction reply cancelled: {message_key}")
+        discard_abandoned_conversation(message_key, e, user_id, context.team_id)
+        client.chat_update(channel=channel, ts=responding_msg["ts"], text=CANCELLED_TEXT)
+
     except Exception as e:
         print(f"   ❌ Reaction handler error: {e}")
+        discard_abandoned_conversation(message_key, e, user_id, context.team_id)
         logger.error(f"Reaction handler error: {e}")
         # 發送錯誤訊息給觸發的用戶
         try:
@@ -538,6 +865,10 @@ def handle_reaction(event, client, logger):
         except:
             pass
 
+    finally:
+        if cancel_token:
+            finish_request(cancel_token, message_key=message_key)
+
 
 # ============================================
 # 監聽關鍵字（保留原有功能）
@@ -568,8 +899,21 @@ if __name__ == "__main__":
     print("😀 Emoji 觸發:")
     print("   📝 摘要 | 🇺🇸 翻英 | 🇯🇵 翻日 | 🇹🇼 翻繁中 | ❓ 解釋")
     print("=" * 50)
-    print(f"🔗 Dify API: {dify.base_url}")
+    print(f"🔗 Dify API: {workspaces.default_dify.base_url}")
+    if workspaces.default_oneshot:
+        print(f"⚡ 一次性問答: {workspaces.default_oneshot.mode} App")
     print("=" * 50)
 
+    if MULTI_WORKSPACE and os.environ.get("OAUTH_BUILTIN_SERVER", "true").lower() == "true":
+        # OAuth 安裝流程需要 HTTP endpoint（/slack/install、/slack/oauth_redirect）
+        # 事件仍透過 Socket Mode 接收
+        oauth_port = int(os.environ.get("PORT", "3000"))
+        print(f"🏢 多 workspace 模式：http://localhost:{oauth_port}/slack/install")
+        serve_oauth(oauth_app, oauth_port)
+
+    reaper.start()
+    if reaper.max_idle_seconds > 0:
+        print(f"🧹 閒置 {reaper.max_idle_seconds / 3600:g} 小時的 Dify 對話會自動刪除")
+
     handler = SocketModeHandler(app, os.environ["SLACK_APP_TOKEN"])
     handler.start()
@@ -0,0 +1,372 @@
+"""
+批次處理 Slack 匯出資料
+對整個頻道封存執行 EMOJI_ACTIONS 的動作（翻譯、摘要...），結果寫成 JSONL
+
+用法：
+    python batch.py ./slack-export --action flag-us --output results.jsonl
+    python batch.py ./slack-export --action memo --channel incident --by-day
+
+輸出檔同時是 checkpoint：重新執行時會略過已寫入的訊息；
+內容相同的訊息（以內容 hash 判斷）只送一次 Dify，每則訊息仍各寫一筆結果
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Generator, Iterable, Optional
+
+from dotenv import load_dotenv
+
+from dify_client import DifyClient, oneshot_client_from_env
+from prompts import EMOJI_ACTIONS
+
+logger = logging.getLogger("batch")
+
+# 不處理的系統訊息
+SKIPPED_SUBTYPES = {
+    "channel_join",
+    "channel_leave",
+    "channel_topic",
+    "channel_purpose",
+    "channel_name",
+    "channel_archive",
+    "channel_unarchive",
+    "pinned_item",
+    "unpinned_item",
+}
+
+
+def iter_json_array(path: str, chunk_size: int = 64 * 1024) -> Generator[dict, None, None]:
+    """逐筆讀取 JSON 陣列檔，不把整個檔案載入記憶體"""
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    eof = False
+
+    with open(path, encoding="utf-8") as f:
+        while True:
+            buffer = buffer.lstrip(" \t\r\n,")
+
+            if not started and buffer:
+                if buffer[0] != "[":
+                    raise ValueError(f"{path} is not a JSON array")
+                buffer = buffer[1:]
+                started = True
+                continue
+
+            if started and buffer.startswith("]"):
+                return
+
+            if buffer:
+                try:
+                    item, end = decoder.raw_decode(buffer)
+                except json.JSONDecodeError:
+                    # 物件還沒讀完整
+                    if eof:
+                        raise
+                else:
+                    buffer = buffer[end:]
+                    yield item
+                    continue
+
+            if eof:
+                if started:
+                    raise ValueError(f"{path}: unexpected end of file")
+                return
+
+            chunk = f.read(chunk_size)
+            if not chunk:
+                eof = True
+            buffer += chunk
+
+
+def list_export_files(export_dir: str, channels: Optional[list[str]] = None) -> list[tuple[str, str]]:
+    """列出匯出目錄中的 (channel, 每日 JSON 檔路徑)，依日期排序"""
+    files = []
+    for channel in sorted(os.listdir(export_dir)):
+        channel_dir = os.path.join(export_dir, channel)
+        if not os.path.isdir(channel_dir):
+            continue
+        if channels and channel not in channels:
+            continue
+
+        for name in sorted(os.listdir(channel_dir)):
+            if name.endswith(".json"):
+                files.append((channel, os.path.join(channel_dir, name)))
+    return files
+
+
+def iter_messages(files: Iterable[tuple[str, str]]) -> Generator[dict, None, None]:
+    """逐則產生需要處理的訊息"""
+    for channel, path in files:
+        for message in iter_json_array(path):
+            if message.get("subtype") in SKIPPED_SUBTYPES:
+                continue
+            text = (message.get("text") or "").strip()
+            if not text:
+                continue
+
+            yield {
+                "channel": channel,
+                "file": os.path.basename(path),
+                "ts": message.get("ts", ""),
+                "user": message.get("user") or message.get("username", ""),
+                "text": text,
+            }
+
+
+def iter_days(files: Iterable[tuple[str, str]]) -> Generator[dict, None, None]:
+    """以「頻道 + 一天」為單位合併訊息（適合摘要）"""
+    for channel, path in files:
+        lines = []
+        first_ts = ""
+        for message in iter_json_array(path):
+            if message.get("subtype") in SKIPPED_SUBTYPES:
+                continue
+            text = (message.get("text") or "").strip()
+            if not text:
+                continue
+
+            first_ts = first_ts or message.get("ts", "")
+            user = message.get("user") or message.get("username", "")
+            lines.append(f"{user}: {text}")
+
+        if lines:
+            yield {
+                "channel": channel,
+                "file": os.path.basename(path),
+                "ts": first_ts,
+                "user": "",
+                "text": "\n".join(lines),
+            }
+
+
+def content_hash(action: str, text: str) -> str:
+    """以動作與內容計算 hash，用來判斷是否處理過"""
+    return hashlib.sha256(f"{action}\n{text}".encode("utf-8")).hexdigest()
+
+
+def record_key(item: dict) -> str:
+    """輸出紀錄對應的訊息（或某頻道某天）"""
+    return f"{item['channel']}/{item['file']}/{item['ts']}"
+
+
+def truncate_partial_line(output_path: str, chunk_size: int = 64 * 1024) -> None:
+    """移除中斷時留下寫一半的最後一行，避免接續寫入時黏在同一行"""
+    if not os.path.exists(output_path):
+        return
+
+    with open(output_path, "rb+") as f:
+        end = f.seek(0, os.SEEK_END)
+        position = end
+        while position > 0:
+            start = max(0, position - chunk_size)
+            f.seek(start)
+            chunk = f.read(position - start)
+            newline = chunk.rfind(b"\n")
+            if newline != -1:
+                position = start + newline + 1
+                break
+            position = start
+
+        if position < end:
+            f.truncate(position)
+
+
+def load_checkpoint(output_path: str) -> tuple[set[str], dict[str, str]]:
+    """從既有輸出檔讀取已寫入的訊息，以及各內容 hash 的結果（checkpoint）"""
+    done = set()
+    results = {}
+    if not os.path.exists(output_path):
+        return done, results
+
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                done.add(record_key(record))
+                results[record["hash"]] = record["result"]
+            except (json.JSONDecodeError, KeyError):
+                continue
+    return done, results
+
+
+class BatchRunner:
+    """用有上限的 worker pool 送出 Dify 請求並寫入結果"""
+
+    def __init__(
+        self,
+        dify: DifyClient,
+        action: str,
+        output_path: str,
+        workers: int = 4,
+        retries: int = 3,
+        user: str = "batch-cli",
+        report_interval: float = 10.0,
+    ):
+        self.dify = dify
+        self.action = action
+        self.prompt = EMOJI_ACTIONS[action]["prompt"]
+        self.output_path = output_path
+        self.workers = workers
+        self.retries = retries
+        self.user = user
+        self.report_interval = report_interval
+
+        self.done, self.results = load_checkpoint(output_path)
+        self.processed = 0
+        self.reused = 0
+        self.skipped = 0
+        self.failed = 0
+
+        self._lock = threading.Lock()
+        # 處理中的 hash -> 等待結果的訊息
+        self._waiting: dict[str, list[dict]] = {}
+        # 限制排隊中的工作數，避免把整個匯出讀進記憶體
+        self._slots = threading.BoundedSemaphore(workers * 2)
+
+    def run(self, items: Iterable[dict]) -> None:
+        self._started_at = time.monotonic()
+        last_report = self._started_at
+
+        truncate_partial_line(self.output_path)
+
+        with open(self.output_path, "a", encoding="utf-8") as output:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for item in items:
+                    item["hash"] = content_hash(self.action, item["text"])
+                    key = record_key(item)
+                    with self._lock:
+                        if key in self.done:
+                            self.skipped += 1
+                            continue
+                        self.done.add(key)
+
+                        # 重複的內容沿用之前的結果，不再送 Dify
+                        if item["hash"] in self.results:
+                            self._write(item, self.results[item["hash"]], output)
+                            self.reused += 1
+                            continue
+                        waiting = self._waiting.get(item["hash"])
+                        if waiting is not None:
+                            waiting.append(item)
+                            continue
+                        self._waiting[item["hash"]] = [item]
+
+                    self._slots.acquire()
+                    future = pool.submit(self._process, item, output)
+                    future.add_done_callback(lambda _: self._slots.release())
+
+                    if time.monotonic() - last_report >= self.report_interval:
+                        self.report()
+                        last_report = time.monotonic()
+
+        self.report()
+
+    def _process(self, item: dict, output) -> None:
+        prompt = self.prompt.format(text=item["text"])
+
+        for attempt in range(self.retries + 1):
+            try:
+                answer = self.dify.complete(query=prompt, user=self.user, stream=True)
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    logger.error(f"Failed {item['channel']}/{item['file']} ts={item['ts']}: {e}")
+                    with self._lock:
+                        # 失敗的不算完成，下次執行會重試
+                        for waiting in self._waiting.pop(item["hash"]):
+                            self.done.discard(record_key(waiting))
+                            self.failed += 1
+                    return
+                time.sleep(2 ** attempt)
+
+        with self._lock:
+            self.results[item["hash"]] = answer
+            self.processed += 1
+            waiting = self._waiting.pop(item["hash"])
+            for waiting_item in waiting:
+                self._write(waiting_item, answer, output)
+            self.reused += len(waiting) - 1
+
+    def _write(self, item: dict, answer: str, output) -> None:
+        """寫入一筆結果，需持有 self._lock"""
+        record = {**item, "action": EMOJI_ACTIONS[self.action]["action"], "result": answer}
+        output.write(json.dumps(record, ensure_ascii=False) + "\n")
+        output.flush()
+
+    def report(self) -> None:
+        elapsed = time.monotonic() - self._started_at
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        logger.info(
+            f"processed={self.processed} reused={self.reused} skipped={self.skipped} failed={self.failed} "
+            f"elapsed={elapsed:.0f}s throughput={rate:.2f} msg/s"
+        )
+
+
+def main(argv: Optional[list[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="批次翻譯／摘要 Slack 匯出資料")
+    parser.add_argument("export_dir", help="Slack 匯出資料目錄（解壓縮後）")
+    parser.add_argument("--action", required=True, choices=sorted(EMOJI_ACTIONS), help="EMOJI_ACTIONS 的 emoji 名稱")
+    parser.add_argument("--output", default="results.jsonl", help="輸出 JSONL（也是 checkpoint）")
+    parser.add_argument("--channel", action="append", dest="channels", help="只處理指定頻道，可重複")
+    parser.add_argument("--by-day", action="store_true", help="以每天為單位合併訊息後處理")
+    parser.add_argument("--workers", type=int, default=4, help="同時送出的請求數")
+    parser.add_argument("--retries", type=int, default=3, help="失敗重試次數")
+    parser.add_argument("--user", default="batch-cli", help="送給 Dify 的 user 識別碼")
+    parser.add_argument(
+        "--allow-chat-app",
+        action="store_true",
+        help="未設定 DIFY_ONESHOT_API_KEY 時改用 chat App（每則訊息都會在 Dify 留下一個對話）",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s',
+        datefmt='%H:%M:%S'
+    )
+    load_dotenv()
+
+    files = list_export_files(args.export_dir, args.channels)
+    if not files:
+        logger.error(f"No channel files found in {args.export_dir}")
+        return 1
+
+    dify = oneshot_client_from_env()
+    if dify is None:
+        if not args.allow_chat_app:
+            logger.error(
+                "DIFY_ONESHOT_API_KEY is not set. The chat App would leave one Dify conversation "
+                "per message that nothing deletes; set up a completion/workflow App or pass --allow-chat-app"
+            )
+            return 1
+        logger.warning(
+            "Using the chat App: every message creates a Dify conversation that is never deleted "
+            "(the conversation reaper only runs in the bot)"
+        )
+        dify = DifyClient()
+
+    runner = BatchRunner(
+        dify=dify,
+        action=args.action,
+        output_path=args.output,
+        workers=args.workers,
+        retries=args.retries,
+        user=args.user,
+    )
+    logger.info(f"{len(files)} files, {len(runner.done)} already done")
+
+    items = iter_days(files) if args.by_day else iter_messages(files)
+    runner.run(items)
+    return 1 if runner.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
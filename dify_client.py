@@ -1,27 +1,130 @@
 """
-Dify Chat API Client
-支援 streaming 和 blocking 模式
+Dify API Client
+支援 Chat、Completion、Workflow 三種 App，streaming 和 blocking 模式
 """
 
 import os
 import json
+import queue
+import socket
+import threading
 import httpx
-from typing import Generator, Optional
+from typing import Callable, Generator, Iterable, Optional
+
+
+class DifyError(Exception):
+    """
+    Dify 請求中途失敗
+    conversation_id: 這次請求新建立的對話（沒有則為空字串），呼叫端需自行清除
+    """
+
+    def __init__(self, message: str, conversation_id: str = ""):
+        super().__init__(message)
+        self.conversation_id = conversation_id
+
+
+class DifyCancelledError(DifyError):
+    """請求已被取消"""
+
+
+class CancelToken:
+    """可從其他 thread 取消進行中請求的 token"""
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self._callbacks: list[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self) -> None:
+        """取消請求，已登記的 callback 在背景 thread 執行（只會執行一次）"""
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            self._cancelled.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        self._run_in_background(callbacks)
+
+    def on_cancel(self, callback: Callable[[], None]) -> None:
+        """登記取消時要執行的 callback，已取消則立即在背景執行"""
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._callbacks.append(callback)
+                return
+
+        self._run_in_background([callback])
+
+    @staticmethod
+    def _run_in_background(callbacks: list[Callable[[], None]]) -> None:
+        """callback 可能是 blocking 的 HTTP 呼叫，不佔用呼叫 cancel() 的 thread"""
+        if not callbacks:
+            return
+
+        def run():
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    pass
+
+        threading.Thread(target=run, name="cancel-callbacks", daemon=True).start()
+
+
+def _abort_response(response: httpx.Response) -> None:
+    """
+    中斷 streaming 回應
+    其他 thread 正卡在讀取時 close() 不會讓它返回，要先 shutdown socket
+    """
+    network_stream = response.extensions.get("network_stream")
+    sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
 
 
 class DifyClient:
-    """Dify Chat API 客戶端"""
+    """
+    Dify API 客戶端
+
+    mode:
+        chat: 對話型 App（/chat-messages），可用 conversation_id 延續對話
+        completion: 文字生成 App（/completion-messages），不建立對話
+        workflow: Workflow App（/workflows/run），不建立對話
+    """
+
+    MODES = ("chat", "completion", "workflow")
 
     def __init__(
         self,
         api_key: str = None,
         base_url: str = None,
+        mode: str = "chat",
+        query_variable: str = "query",
     ):
         self.api_key = api_key or os.environ.get("DIFY_API_KEY")
         self.base_url = (base_url or os.environ.get("DIFY_BASE_URL", "https://api.dify.ai/v1")).rstrip("/")
+        self.mode = mode
+        # completion / workflow App 的問題放在 inputs 的哪個變數
+        self.query_variable = query_variable
 
         if not self.api_key:
             raise ValueError("DIFY_API_KEY is required")
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown Dify app mode: {mode}")
+
+        # 共用連線池，避免每次請求重新建立 TCP/TLS 連線
+        self._http = httpx.Client(timeout=120.0)
+
+    def close(self) -> None:
+        """關閉連線池"""
+        self._http.close()
 
     def _headers(self) -> dict:
         return {
@@ -29,6 +132,172 @@ class DifyClient:
             "Content-Type": "application/json",
         }
 
+    def _post(self, path: str, payload: dict) -> dict:
+        """Blocking 模式送出請求"""
+        response = self._http.post(
+            f"{self.base_url}{path}",
+            headers=self._headers(),
+            json=payload,
+        )
+        response.raise_for_status()
+        return response.json()
+
+    @staticmethod
+    def _parse_sse_line(line: str) -> Optional[dict]:
+        """解析一行 SSE，不是資料行時回傳 None"""
+        if not line.startswith("data: "):
+            return None
+        data = line[6:]  # 移除 "data: " 前綴
+        if not data.strip():
+            return None
+        try:
+            return json.loads(data)
+        except json.JSONDecodeError:
+            return None
+
+    def _stream(
+        self,
+        path: str,
+        payload: dict,
+        cancel_token: Optional[CancelToken] = None,
+    ) -> Generator[dict, None, None]:
+        """
+        Streaming 模式送出請求，逐一產生 SSE 事件
+
+        有 cancel_token 時由背景 thread 讀取，取消後立即拋出 DifyCancelledError；
+        背景 thread 讀到 task_id 後呼叫停止生成並關閉連線，
+        取消後才得知的新對話也由背景 thread 刪除
+        """
+        if cancel_token is None:
+            with self._http.stream(
+                "POST",
+                f"{self.base_url}{path}",
+                headers=self._headers(),
+                json=payload,
+            ) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    event = self._parse_sse_line(line)
+                    if event is not None:
+                        yield event
+            return
+
+        events: queue.Queue = queue.Queue()
+        done = object()
+
+        # 這次請求新建立的對話，由先知道的一方（呼叫端或背景 thread）負責清除
+        creates_conversation = path == "/chat-messages" and not payload.get("conversation_id")
+        new_conversation = {"id": "", "reported": False, "abandoned": False}
+        new_conversation_lock = threading.Lock()
+
+        def claim_new_conversation(event: dict) -> None:
+            conversation_id = event.get("conversation_id")
+            if not creates_conversation or not conversation_id:
+                return
+            with new_conversation_lock:
+                if not new_conversation["id"]:
+                    new_conversation["id"] = conversation_id
+                    # 呼叫端已經拋出取消，不會再處理這個對話
+                    new_conversation["abandoned"] = new_conversation["reported"]
+
+        def read():
+            try:
+                with self._http.stream(
+                    "POST",
+                    f"{self.base_url}{path}",
+                    headers=self._headers(),
+                    json=payload,
+                ) as response:
+                    response.raise_for_status()
+                    task_id = None
+
+                    for line in response.iter_lines():
+                        event = self._parse_sse_line(line)
+                        if event is None:
+                            continue
+
+                        claim_new_conversation(event)
+
+                        if task_id is None and event.get("task_id"):
+                            task_id = event["task_id"]
+
+                            def stop_and_close(task_id=task_id):
+                                self.stop(task_id, payload["user"])
+                                _abort_response(response)
+                                if new_conversation["abandoned"]:
+                                    self.delete_conversation(new_conversation["id"], payload["user"])
+
+                            # 已取消時會立即在背景執行
+                            cancel_token.on_cancel(stop_and_close)
+
+                        if cancel_token.cancelled:
+                            # 還沒有 task_id 就繼續讀，才能呼叫停止生成
+                            if task_id:
+                                return
+                            continue
+
+                        events.put(event)
+            except Exception as e:
+                if not cancel_token.cancelled:
+                    events.put(e)
+            finally:
+                events.put(done)
+
+        threading.Thread(target=read, name="dify-stream", daemon=True).start()
+        cancel_token.on_cancel(lambda: events.put(done))
+
+        while True:
+            item = events.get()
+            if cancel_token.cancelled:
+                with new_conversation_lock:
+                    new_conversation["reported"] = True
+                    conversation_id = new_conversation["id"]
+                raise DifyCancelledError("Request cancelled", conversation_id=conversation_id)
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def _stateless_payload(
+        self,
+        query: str,
+        user: str,
+        response_mode: str,
+        inputs: Optional[dict] = None,
+        files: Optional[list] = None,
+    ) -> dict:
+        """completion / workflow 的 payload，問題放進 inputs"""
+        payload = {
+            "inputs": {**(inputs or {}), self.query_variable: query},
+            "user": user,
+            "response_mode": response_mode,
+        }
+
+        if files:
+            payload["files"] = files
+
+        return payload
+
+    @staticmethod
+    def _workflow_answer(outputs: Optional[dict]) -> str:
+        """從 workflow outputs 取出回答文字"""
+        outputs = outputs or {}
+        for key in ("answer", "text", "result", "output"):
+            if isinstance(outputs.get(key), str):
+                return outputs[key]
+
+        for value in outputs.values():
+            if isinstance(value, str):
+                return value
+        return ""
+
+    @staticmethod
+    def _check_workflow_status(data: dict) -> None:
+        """workflow 執行失敗、停止時拋出例外"""
+        if data.get("status") not in (None, "succeeded"):
+            raise Exception(f"Dify workflow {data.get('status')}: {data.get('error') or 'Unknown error'}")
+
     def chat(
         self,
         query: str,
@@ -63,14 +332,7 @@ class DifyClient:
         if files:
             payload["files"] = files
 
-        with httpx.Client(timeout=120.0) as client:
-            response = client.post(
-                f"{self.base_url}/chat-messages",
-                headers=self._headers(),
-                json=payload,
-            )
-            response.raise_for_status()
-            return response.json()
+        return self._post("/chat-messages", payload)
 
     def chat_stream(
         self,
@@ -79,6 +341,7 @@ class DifyClient:
         conversation_id: Optional[str] = None,
         inputs: Optional[dict] = None,
         files: Optional[list] = None,
+        cancel_token: Optional[CancelToken] = None,
     ) -> Generator[dict, None, None]:
         """
         Streaming 模式發送聊天訊息
@@ -89,6 +352,7 @@ class DifyClient:
             conversation_id: 對話 ID（用於延續對話）
             inputs: 額外輸入變數
             files: 檔案列表
+            cancel_token: 取消後停止讀取並關閉連線
 
         Yields:
             每個 SSE 事件的 dict
@@ -106,58 +370,121 @@ class DifyClient:
         if files:
             payload["files"] = files
 
-        with httpx.Client(timeout=120.0) as client:
-            with client.stream(
-                "POST",
-                f"{self.base_url}/chat-messages",
-                headers=self._headers(),
-                json=payload,
-            ) as response:
-                response.raise_for_status()
+        yield from self._stream("/chat-messages", payload, cancel_token)
 
-                for line in response.iter_lines():
-                    if line.startswith("data: "):
-                        data = line[6:]  # 移除 "data: " 前綴
-                        if data.strip():
-                            try:
-                                yield json.loads(data)
-                            except json.JSONDecodeError:
-                                continue
+    def completion(
+        self,
+        query: str,
+        user: str,
+        inputs: Optional[dict] = None,
+        files: Optional[list] = None,
+    ) -> dict:
+        """
+        Blocking 模式呼叫文字生成 App（不建立對話）
 
-    def chat_complete(
+        Returns:
+            完整的回應 dict
+        """
+        payload = self._stateless_payload(query, user, "blocking", inputs, files)
+        return self._post("/completion-messages", payload)
+
+    def completion_stream(
         self,
         query: str,
         user: str,
-        conversation_id: Optional[str] = None,
         inputs: Optional[dict] = None,
         files: Optional[list] = None,
-        stream: bool = True,
-    ) -> tuple[str, str]:
+        cancel_token: Optional[CancelToken] = None,
+    ) -> Generator[dict, None, None]:
         """
-        便捷方法：發送訊息並返回完整回應
+        Streaming 模式呼叫文字生成 App（不建立對話）
+
+        Yields:
+            每個 SSE 事件的 dict
+        """
+        payload = self._stateless_payload(query, user, "streaming", inputs, files)
+        yield from self._stream("/completion-messages", payload, cancel_token)
+
+    def workflow_run(
+        self,
+        query: str,
+        user: str,
+        inputs: Optional[dict] = None,
+        files: Optional[list] = None,
+    ) -> dict:
+        """
+        Blocking 模式執行 Workflow
+
+        Returns:
+            完整的回應 dict
+        """
+        payload = self._stateless_payload(query, user, "blocking", inputs, files)
+        return self._post("/workflows/run", payload)
+
+    def workflow_stream(
+        self,
+        query: str,
+        user: str,
+        inputs: Optional[dict] = None,
+        files: Optional[list] = None,
+        cancel_token: Optional[CancelToken] = None,
+    ) -> Generator[dict, None, None]:
+        """
+        Streaming 模式執行 Workflow
+
+        Yields:
+            每個 SSE 事件的 dict
+        """
+        payload = self._stateless_payload(query, user, "streaming", inputs, files)
+        yield from self._stream("/workflows/run", payload, cancel_token)
+
+    def stop(self, task_id: str, user: str) -> None:
+        """
+        停止生成（僅 streaming 模式有效）
+
+        Args:
+            task_id: streaming 事件中的 task_id
+            user: 用戶識別碼，需與發送訊息時相同
+        """
+        paths = {
+            "chat": f"/chat-messages/{task_id}/stop",
+            "completion": f"/completion-messages/{task_id}/stop",
+            "workflow": f"/workflows/tasks/{task_id}/stop",
+        }
+        self._post(paths[self.mode], {"user": user})
+
+    def delete_conversation(self, conversation_id: str, user: str) -> None:
+        """
+        刪除 Dify 端的對話（僅 chat App）
 
         Args:
-            query: 用戶問題
-            user: 用戶識別碼
             conversation_id: 對話 ID
-            inputs: 額外輸入變數
-            files: 檔案列表
-            stream: 是否使用 streaming 模式
+            user: 用戶識別碼，需與建立對話時相同
+        """
+        response = self._http.request(
+            "DELETE",
+            f"{self.base_url}/conversations/{conversation_id}",
+            headers=self._headers(),
+            json={"user": user},
+        )
+        response.raise_for_status()
+
+    def _accumulate(
+        self,
+        events: Iterable[dict],
+        conversation_id: Optional[str] = None,
+    ) -> tuple[str, str]:
+        """
+        累積 streaming 事件成完整回答
 
         Returns:
-            (answer, conversation_id) 元組
+            (answer, conversation_id) 元組，completion / workflow 的 conversation_id 為空字串
         """
-        if stream:
-            answer_parts = []
-            final_conversation_id = conversation_id
+        answer_parts = []
+        final_conversation_id = conversation_id
 
-            for event in self.chat_stream(
-                query=query,
-                user=user,
-                conversation_id=conversation_id,
-                inputs=inputs,
-                files=files,
-            ):
+        try:
+            for event in events:
                 event_type = event.get("event")
 
                 if event_type == "message":
@@ -171,10 +498,68 @@ class DifyClient:
                     # 獲取最終的 conversation_id
                     final_conversation_id = event.get("conversation_id", final_conversation_id)
 
+                elif event_type == "text_chunk":
+                    # Workflow 的文字片段
+                    answer_parts.append(event.get("data", {}).get("text", ""))
+
+                elif event_type == "workflow_finished":
+                    data = event.get("data", {})
+                    self._check_workflow_status(data)
+                    # 沒有 streaming 文字時改用最終 outputs
+                    if not answer_parts:
+                        answer_parts.append(self._workflow_answer(data.get("outputs")))
+
                 elif event_type == "error":
                     raise Exception(f"Dify error: {event.get('message', 'Unknown error')}")
 
-            return "".join(answer_parts), final_conversation_id
+        except DifyError:
+            raise
+        except Exception as e:
+            # 中途失敗時帶上已建立的新對話，讓呼叫端清除
+            if final_conversation_id and final_conversation_id != conversation_id:
+                raise DifyError(str(e), conversation_id=final_conversation_id) from e
+            raise
+
+        return "".join(answer_parts), final_conversation_id or ""
+
+    def chat_complete(
+        self,
+        query: str,
+        user: str,
+        conversation_id: Optional[str] = None,
+        inputs: Optional[dict] = None,
+        files: Optional[list] = None,
+        stream: bool = True,
+        cancel_token: Optional[CancelToken] = None,
+    ) -> tuple[str, str]:
+        """
+        便捷方法：發送訊息並返回完整回應
+
+        Args:
+            query: 用戶問題
+            user: 用戶識別碼
+            conversation_id: 對話 ID
+            inputs: 額外輸入變數
+            files: 檔案列表
+            stream: 是否使用 streaming 模式
+            cancel_token: 取消 token（僅 streaming 模式），
+                取消時會呼叫 Dify 停止生成並拋出 DifyCancelledError
+
+        Returns:
+            (answer, conversation_id) 元組
+        """
+        if stream:
+            return self._accumulate(
+                self.chat_stream(
+                    query=query,
+                    user=user,
+                    conversation_id=conversation_id,
+                    inputs=inputs,
+                    files=files,
+                    cancel_token=cancel_token,
+                ),
+                conversation_id=conversation_id,
+            )
 
         else:
             result = self.chat(
@@ -186,6 +571,75 @@ class DifyClient:
             )
             return result.get("answer", ""), result.get("conversation_id", "")
 
+    def complete(
+        self,
+        query: str,
+        user: str,
+        inputs: Optional[dict] = None,
+        files: Optional[list] = None,
+        stream: bool = True,
+        cancel_token: Optional[CancelToken] = None,
+    ) -> str:
+        """
+        便捷方法：一次性問答，依 mode 選擇 API
+
+        completion / workflow App 不會在 Dify 建立對話；
+        chat App 則每次開新對話（相容未設定 completion App 的情況）
+
+        Returns:
+            完整回答
+        """
+        if self.mode == "chat":
+            answer, _ = self.chat_complete(
+                query=query,
+                user=user,
+                inputs=inputs,
+                files=files,
+                stream=stream,
+                cancel_token=cancel_token,
+            )
+            return answer
+
+        if stream:
+            stream_method = self.completion_stream if self.mode == "completion" else self.workflow_stream
+            answer, _ = self._accumulate(
+                stream_method(
+                    query=query,
+                    user=user,
+                    inputs=inputs,
+                    files=files,
+                    cancel_token=cancel_token,
+                ),
+            )
+            return answer
+
+        if self.mode == "completion":
+            return self.completion(query=query, user=user, inputs=inputs, files=files).get("answer", "")
+
+        data = self.workflow_run(query=query, user=user, inputs=inputs, files=files).get("data", {})
+        self._check_workflow_status(data)
+        return self._workflow_answer(data.get("outputs"))
+
+
+def oneshot_client_from_env() -> Optional[DifyClient]:
+    """
+    依環境變數建立一次性問答用的 client，未設定 DIFY_ONESHOT_API_KEY 時回傳 None
+
+    DIFY_ONESHOT_MODE: completion（預設）或 workflow
+    DIFY_ONESHOT_QUERY_VARIABLE: 問題放入的 inputs 變數名稱（預設 query）
+    DIFY_ONESHOT_BASE_URL: 預設同 DIFY_BASE_URL
+    """
+    api_key = os.environ.get("DIFY_ONESHOT_API_KEY")
+    if not api_key:
+        return None
+
+    return DifyClient(
+        api_key=api_key,
+        base_url=os.environ.get("DIFY_ONESHOT_BASE_URL"),
+        mode=os.environ.get("DIFY_ONESHOT_MODE", "completion"),
+        query_variable=os.environ.get("DIFY_ONESHOT_QUERY_VARIABLE", "query"),
+    )
+
 
 # 簡易測試
 if __name__ == "__main__":
@@ -212,3 +666,13 @@ if __name__ == "__main__":
     )
     print(f"Answer: {answer}")
     print(f"Conversation ID: {conv_id}")
+
+    oneshot = oneshot_client_from_env()
+    if oneshot:
+        print(f"\nTesting one-shot {oneshot.mode} mode...")
+        answer = oneshot.complete(
+            query="用一句話介紹你自己",
+            user="test-user",
+            stream=True,
+        )
+        print(f"Answer: {answer}")
@@ -0,0 +1,46 @@
+"""
+Prompt 模板
+Slack emoji 觸發與批次 CLI 共用
+"""
+
+# Emoji 對應的動作
+# 注意：Slack emoji 名稱可能因 workspace 而異
+EMOJI_ACTIONS = {
+    # 📝 摘要
+    "memo": {
+        "action": "summarize",
+        "prompt": "請摘要以下內容，用繁體中文回覆：\n\n{text}",
+    },
+    # 🇺🇸 翻英文（多種可能的名稱）
+    "flag-us": {
+        "action": "translate",
+        "prompt": "請將以下內容翻譯成英文：\n\n{text}",
+    },
+    "us": {
+        "action": "translate",
+        "prompt": "請將以下內容翻譯成英文：\n\n{text}",
+    },
+    # 🇯🇵 翻日文
+    "flag-jp": {
+        "action": "translate",
+        "prompt": "請將以下內容翻譯成日文：\n\n{text}",
+    },
+    "jp": {
+        "action": "translate",
+        "prompt": "請將以下內容翻譯成日文：\n\n{text}",
+    },
+    # 🇹🇼 翻繁中
+    "flag-tw": {
+        "action": "translate",
+        "prompt": "請將以下內容翻譯成繁體中文：\n\n{text}",
+    },
+    "tw": {
+        "action": "translate",
+        "prompt": "請將以下內容翻譯成繁體中文：\n\n{text}",
+    },
+    # ❓ 解釋
+    "question": {
+        "action": "explain",
+        "prompt": "請解釋以下內容，用繁體中文回覆：\n\n{text}",
+    },
+}
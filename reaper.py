@@ -0,0 +1,234 @@
+"""
+Dify 對話回收
+追蹤每個對話最後使用時間，在背景刪除閒置過久的 Dify 對話
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import httpx
+
+from dify_client import DifyClient
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class TrackedConversation:
+    """對話的使用紀錄"""
+
+    conversation_id: str
+    user: str
+    team_id: Optional[str]
+    last_used: float
+
+
+@dataclass
+class PendingDeletion:
+    """等待刪除的 Dify 對話"""
+
+    conversation_id: str
+    user: str
+    team_id: Optional[str]
+    attempts: int = 0
+
+
+class ConversationReaper:
+    """
+    背景回收閒置的 Dify 對話
+
+    - touch(): 每次使用對話時更新最後使用時間，已排入刪除的對話回傳 False
+    - discard(): 立即排入刪除（例如 /reset）
+    - 背景 thread 定期把閒置超過 max_idle_seconds 的對話從本地 mapping 移除並刪除 Dify 端資料，
+      is_busy(key) 為 True（請求進行中）的對話不回收
+    - 刪除依 deletes_per_second 限速，每 batch_size 筆記錄一次進度
+    """
+
+    MAX_ATTEMPTS = 3
+    # 排入刪除的對話 ID 保留多久，避免進行中的請求把它寫回 mapping
+    DISCARDED_TTL_SECONDS = 3600
+
+    def __init__(
+        self,
+        conversations: dict[str, str],
+        client_for: Callable[[Optional[str]], DifyClient],
+        max_idle_seconds: Optional[float] = None,
+        interval_seconds: Optional[float] = None,
+        batch_size: Optional[int] = None,
+        deletes_per_second: Optional[float] = None,
+        is_busy: Optional[Callable[[str], bool]] = None,
+    ):
+        if max_idle_seconds is None:
+            max_idle_seconds = float(os.environ.get("CONVERSATION_IDLE_HOURS", "24")) * 3600
+        if interval_seconds is None:
+            interval_seconds = float(os.environ.get("REAPER_INTERVAL_SECONDS", "300"))
+        if batch_size is None:
+            batch_size = int(os.environ.get("REAPER_BATCH_SIZE", "20"))
+        if deletes_per_second is None:
+            deletes_per_second = float(os.environ.get("REAPER_DELETES_PER_SECOND", "2"))
+
+        self.conversations = conversations
+        self.client_for = client_for
+        self.max_idle_seconds = max_idle_seconds
+        self.interval_seconds = interval_seconds
+        self.batch_size = max(1, batch_size)
+        self.deletes_per_second = deletes_per_second
+        self.is_busy = is_busy or (lambda key: False)
+
+        # 指標
+        self.reaped = 0
+        self.failed = 0
+
+        self._tracked: dict[str, TrackedConversation] = {}
+        self._pending: deque[PendingDeletion] = deque()
+        self._retries: list[PendingDeletion] = []
+        # 已排入刪除的對話 ID -> 排入時間
+        self._discarded: dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def touch(self, key: str, conversation_id: str, user: str, team_id: Optional[str] = None) -> bool:
+        """記錄對話被使用，對話已排入刪除時回傳 False"""
+        with self._lock:
+            if conversation_id in self._discarded:
+                return False
+
+            tracked = self._tracked.get(key)
+            if tracked is not None and tracked.conversation_id == conversation_id:
+                # 刪除時需要建立對話的 user，只更新時間
+                tracked.last_used = time.monotonic()
+                return True
+            self._tracked[key] = TrackedConversation(conversation_id, user, team_id, time.monotonic())
+            return True
+
+    def discard(self, key: str, conversation_id: str, user: str, team_id: Optional[str] = None) -> None:
+        """本地已清除的對話，立即排入刪除"""
+        with self._lock:
+            tracked = self._tracked.get(key)
+            if tracked is not None and tracked.conversation_id == conversation_id:
+                del self._tracked[key]
+                user = tracked.user
+            self._discarded[conversation_id] = time.monotonic()
+            self._pending.append(PendingDeletion(conversation_id, user, team_id))
+        self._wakeup.set()
+
+    def stats(self) -> dict:
+        """回收指標"""
+        with self._lock:
+            return {
+                "tracked": len(self._tracked),
+                "pending": len(self._pending) + len(self._retries),
+                "reaped": self.reaped,
+                "failed": self.failed,
+            }
+
+    def start(self) -> None:
+        """啟動背景 thread（max_idle_seconds <= 0 時只處理 discard）"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="conversation-reaper", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self._wakeup.set()
+
+    def _run(self) -> None:
+        while not self._stopped.is_set():
+            try:
+                self.sweep()
+                self.drain()
+            except Exception as e:
+                logger.error(f"Conversation reaper error: {e}")
+
+            self._wakeup.wait(self.interval_seconds)
+            self._wakeup.clear()
+
+    def sweep(self) -> int:
+        """把閒置過久的對話從本地 mapping 移除並排入刪除，回傳數量"""
+        # 上一輪失敗的重新排入
+        with self._lock:
+            self._pending.extend(self._retries)
+            self._retries.clear()
+
+            discarded_deadline = time.monotonic() - self.DISCARDED_TTL_SECONDS
+            for conversation_id, discarded_at in list(self._discarded.items()):
+                if discarded_at < discarded_deadline:
+                    del self._discarded[conversation_id]
+
+        if self.max_idle_seconds <= 0:
+            return 0
+
+        deadline = time.monotonic() - self.max_idle_seconds
+        expired = 0
+
+        with self._lock:
+            for key, tracked in list(self._tracked.items()):
+                if tracked.last_used > deadline or self.is_busy(key):
+                    continue
+
+                del self._tracked[key]
+                # 只移除仍指向同一個對話的 mapping
+                if self.conversations.get(key) == tracked.conversation_id:
+                    self.conversations.pop(key, None)
+                self._discarded[tracked.conversation_id] = time.monotonic()
+                self._pending.append(PendingDeletion(tracked.conversation_id, tracked.user, tracked.team_id))
+                expired += 1
+
+        if expired:
+            logger.info(f"Conversation reaper: {expired} idle conversations queued for deletion")
+        return expired
+
+    def drain(self) -> None:
+        """依速率限制刪除所有等待中的對話"""
+        delay = 1.0 / self.deletes_per_second if self.deletes_per_second > 0 else 0.0
+        processed = 0
+
+        while not self._stopped.is_set():
+            with self._lock:
+                if not self._pending:
+                    break
+                item = self._pending.popleft()
+
+            self._delete(item)
+            processed += 1
+
+            if processed % self.batch_size == 0:
+                logger.info(f"Conversation reaper: {self.stats()}")
+            if delay:
+                self._stopped.wait(delay)
+
+        if processed and processed % self.batch_size:
+            logger.info(f"Conversation reaper: {self.stats()}")
+
+    def _delete(self, item: PendingDeletion) -> None:
+        try:
+            self.client_for(item.team_id).delete_conversation(item.conversation_id, item.user)
+        except httpx.HTTPStatusError as e:
+            # 已經不存在就當作刪除成功
+            if e.response.status_code != 404:
+                self._retry_or_fail(item, e)
+                return
+        except Exception as e:
+            self._retry_or_fail(item, e)
+            return
+
+        with self._lock:
+            self.reaped += 1
+
+    def _retry_or_fail(self, item: PendingDeletion, error: Exception) -> None:
+        item.attempts += 1
+        with self._lock:
+            if item.attempts < self.MAX_ATTEMPTS:
+                # 下一輪再試
+                self._retries.append(item)
+                return
+            self.failed += 1
+        logger.error(f"Failed to delete Dify conversation {item.conversation_id}: {error}")
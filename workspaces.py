@@ -0,0 +1,222 @@
+"""
+多 Workspace 資源管理
+每個 team 各自的 Dify client 與 rate limit bucket
+"""
+
+import os
+import json
+import time
+import threading
+from socketserver import ThreadingMixIn
+from typing import Optional
+from wsgiref.simple_server import WSGIServer, make_server
+
+from slack_bolt import BoltResponse
+from slack_bolt.adapter.wsgi import SlackRequestHandler
+from slack_bolt.authorization import AuthorizeResult
+from slack_bolt.authorization.authorize import InstallationStoreAuthorize
+
+from dify_client import DifyClient, oneshot_client_from_env
+
+
+class RateLimitError(Exception):
+    """team 的請求額度用完"""
+
+
+class TokenBucket:
+    """簡易 token bucket，thread-safe"""
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        """取得一個 token，額度不足時回傳 False"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class CachedInstallationStoreAuthorize(InstallationStoreAuthorize):
+    """
+    以 team 快取授權結果
+    預設每個事件都會查 installation store 並呼叫 auth.test，
+    重新安裝或 token 被撤銷時需呼叫 clear()
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(cache_enabled=True, **kwargs)
+        self._team_cache: dict[tuple, AuthorizeResult] = {}
+        self._team_cache_lock = threading.Lock()
+
+    def __call__(self, *, context, enterprise_id, team_id, user_id, **kwargs) -> Optional[AuthorizeResult]:
+        key = (enterprise_id, team_id)
+        cached = self._team_cache.get(key)
+        if cached is not None:
+            return cached
+
+        result = super().__call__(
+            context=context,
+            enterprise_id=enterprise_id,
+            team_id=team_id,
+            user_id=user_id,
+            **kwargs,
+        )
+        if result is not None:
+            with self._team_cache_lock:
+                self._team_cache[key] = result
+        return result
+
+    def clear(self, enterprise_id: Optional[str], team_id: Optional[str]) -> None:
+        """清除 team 的快取"""
+        with self._team_cache_lock:
+            result = self._team_cache.pop((enterprise_id, team_id), None)
+            if result is not None:
+                self.authorize_result_cache.pop(result.bot_token or result.user_token, None)
+
+
+class OAuthInstallHandler(SlackRequestHandler):
+    """
+    只處理 OAuth 安裝流程（/slack/install、/slack/oauth_redirect）的 WSGI app
+    事件走 Socket Mode，不開放 /slack/events
+    """
+
+    def dispatch(self, request) -> BoltResponse:
+        return BoltResponse(status=404, body="Not Found")
+
+
+class _ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def serve_oauth(wsgi_app: OAuthInstallHandler, port: int) -> WSGIServer:
+    """在背景 thread 以多執行緒 WSGI server 提供 OAuth 安裝頁面"""
+    server = make_server("", port, wsgi_app, server_class=_ThreadingWSGIServer)
+    threading.Thread(target=server.serve_forever, name="oauth-server", daemon=True).start()
+    return server
+
+
+class WorkspaceRegistry:
+    """
+    依 team_id 快取各 workspace 的資源
+
+    Dify 對應設定（DIFY_TEAM_APPS，JSON）：
+        {
+            "T0123": "app-xxx",
+            "T0456": {
+                "api_key": "app-yyy",
+                "base_url": "https://...",
+                "oneshot": {"api_key": "app-zzz", "mode": "workflow"}
+            }
+        }
+    未設定的 team 使用預設的 DIFY_API_KEY / DIFY_BASE_URL，
+    一次性問答則使用 DIFY_ONESHOT_*（未設定時用 chat App）
+    """
+
+    def __init__(
+        self,
+        team_apps: Optional[dict] = None,
+        rate_per_minute: Optional[float] = None,
+    ):
+        if team_apps is None:
+            team_apps = json.loads(os.environ.get("DIFY_TEAM_APPS") or "{}")
+        if rate_per_minute is None:
+            rate_per_minute = float(os.environ.get("TEAM_RATE_LIMIT_PER_MINUTE", "0"))
+
+        self._validate_team_apps(team_apps)
+        self.team_apps = team_apps
+        self.rate_per_minute = rate_per_minute
+
+        # 預設 Dify client（同時用來在啟動時檢查設定）
+        self.default_dify = DifyClient()
+        self.default_oneshot = oneshot_client_from_env()
+
+        self._dify_clients: dict[str, DifyClient] = {}
+        self._oneshot_clients: dict[str, DifyClient] = {}
+        self._buckets: dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _validate_team_apps(team_apps: dict) -> None:
+        """啟動時檢查 DIFY_TEAM_APPS，client 是 lazy 建立的，錯誤設定要在這裡擋下"""
+        if not isinstance(team_apps, dict):
+            raise ValueError("DIFY_TEAM_APPS must be a JSON object")
+
+        for team_id, config in team_apps.items():
+            if isinstance(config, str):
+                config = {"api_key": config}
+            if not isinstance(config, dict) or not config.get("api_key"):
+                raise ValueError(f"DIFY_TEAM_APPS[{team_id}]: api_key is required")
+
+            oneshot_config = config.get("oneshot")
+            if oneshot_config is None:
+                continue
+            # 沒有 api_key 會退回 DIFY_API_KEY（chat App），用 completion / workflow API 呼叫必定失敗
+            if not isinstance(oneshot_config, dict) or not oneshot_config.get("api_key"):
+                raise ValueError(f"DIFY_TEAM_APPS[{team_id}].oneshot: api_key is required")
+            if oneshot_config.get("mode", "completion") not in DifyClient.MODES:
+                raise ValueError(f"DIFY_TEAM_APPS[{team_id}].oneshot: unknown mode {oneshot_config['mode']}")
+
+    def dify(self, team_id: Optional[str]) -> DifyClient:
+        """取得 team 對應的 Dify client"""
+        config = self.team_apps.get(team_id) if team_id else None
+        if not config:
+            return self.default_dify
+
+        with self._lock:
+            client = self._dify_clients.get(team_id)
+            if client is None:
+                if isinstance(config, str):
+                    config = {"api_key": config}
+                client = DifyClient(
+                    api_key=config.get("api_key"),
+                    base_url=config.get("base_url") or self.default_dify.base_url,
+                )
+                self._dify_clients[team_id] = client
+            return client
+
+    def oneshot(self, team_id: Optional[str]) -> DifyClient:
+        """取得 team 一次性問答（emoji、/ask）用的 Dify client"""
+        config = self.team_apps.get(team_id) if team_id else None
+        oneshot_config = config.get("oneshot") if isinstance(config, dict) else None
+        if not oneshot_config:
+            # 有自己 Dify App 的 team 不共用預設的一次性問答 App
+            if config:
+                return self.dify(team_id)
+            return self.default_oneshot or self.default_dify
+
+        with self._lock:
+            client = self._oneshot_clients.get(team_id)
+            if client is None:
+                client = DifyClient(
+                    api_key=oneshot_config.get("api_key"),
+                    base_url=oneshot_config.get("base_url") or config.get("base_url") or self.default_dify.base_url,
+                    mode=oneshot_config.get("mode", "completion"),
+                    query_variable=oneshot_config.get("query_variable", "query"),
+                )
+                self._oneshot_clients[team_id] = client
+            return client
+
+    def acquire(self, team_id: Optional[str]) -> None:
+        """扣除 team 的一次請求額度，超過時拋出 RateLimitError"""
+        if self.rate_per_minute <= 0:
+            return
+
+        key = team_id or "_default"
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate_per_minute)
+                self._buckets[key] = bucket
+
+        if not bucket.try_acquire():
+            raise RateLimitError("此 workspace 請求太頻繁，請稍後再試")